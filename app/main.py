@@ -1,12 +1,81 @@
-from fastapi import FastAPI, HTTPException
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from openai import AsyncOpenAI
+from pydantic import ValidationError
 
-from .models import QueryRequest, QueryResponse
-from .services.flight_api_client import get_flight_data
+from .config import settings
+from .models import QueryRequest
+from .services import flight_api_client, llm_service
+from .services.flight_api_client import FlightAPIError, get_flight_data
 from .services.llm_service import get_answer_from_llm
 
-app = FastAPI(title="Flights by Country Assistant")
+# uvicorn настраивает только свои логгеры uvicorn.*; сообщения app.* уровня INFO выводим сами
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(name)s - %(message)s")
+# httpx пишет каждый запрос к LLM на уровне INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+VALID_AIRPORTS: frozenset[str] = frozenset({"DXB", "LHR", "CDG", "SIN", "HKG", "AMS"})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Одна HTTP-сессия на всё приложение: соединения к FlightAPI переиспользуются между запросами
+    session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=600, keepalive_timeout=60),
+    )
+    app.state.http = session
+    flight_api_client._SESSION = session
+
+    # HTTP/2: параллельные запросы к LLM мультиплексируются в одном соединении с OpenRouter
+    llm_http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(60.0),
+    )
+    app.state.llm = AsyncOpenAI(
+        api_key=settings.OPENROUTER_API_KEY,
+        base_url=llm_service.OPENROUTER_BASE_URL,
+        http_client=llm_http,
+    )
+    llm_service._CLIENT = app.state.llm
+    try:
+        yield
+    finally:
+        flight_api_client._SESSION = None
+        llm_service._CLIENT = None
+        await session.close()
+        await llm_http.aclose()
+
+
+def _sse_event(text: str) -> bytes:
+    """Кодирует фрагмент ответа как событие Server-Sent Events."""
+    return b"data: " + orjson.dumps({"delta": text}) + b"\n\n"
+
+
+async def _sse_stream(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        yield _sse_event(chunk)
+
+
+def _sse_response(events: AsyncIterator[bytes] | list[bytes]) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+app = FastAPI(title="Flights by Country Assistant", lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
@@ -16,13 +85,34 @@ async def read_root():
     return FileResponse('app/static/index.html')
 
 
-@app.post("/api/ask", response_model=QueryResponse)
-async def ask_question(request: QueryRequest):
-    valid_airports = {"DXB", "LHR", "CDG", "SIN", "HKG", "AMS"}
-    if request.airport not in valid_airports:
+# Тело запроса разбирается вручную, поэтому его схема публикуется в OpenAPI явно
+_QUERY_REQUEST_BODY = {
+    "required": True,
+    "content": {"application/json": {"schema": QueryRequest.model_json_schema()}},
+}
+
+
+@app.post("/api/ask", openapi_extra={"requestBody": _QUERY_REQUEST_BODY})
+async def ask_question(request: Request):
+    # Тело разбирается и валидируется за один проход (без промежуточного dict)
+    try:
+        query = QueryRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # loc как у стандартной валидации FastAPI: ["body", <поле>]
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors) from e
+
+    if query.airport not in VALID_AIRPORTS:
         raise HTTPException(status_code=400, detail="Неверный код аэропорта.")
 
-    flight_data = await get_flight_data(request.airport)
-    answer = await get_answer_from_llm(request.question, flight_data, request.airport)
+    try:
+        flight_data, flight_data_str = await get_flight_data(query.airport)
+    except FlightAPIError:
+        raise HTTPException(status_code=502, detail="Не удалось получить данные о рейсах. Попробуйте позже.")
+
+    if not flight_data:
+        return _sse_response([_sse_event("К сожалению, не удалось получить данные о рейсах. Попробуйте позже.")])
 
-    return QueryResponse(answer=answer)
+    # Ответ LLM отдаётся клиенту по мере генерации
+    chunks = get_answer_from_llm(query.question, flight_data_str, query.airport)
+    return _sse_response(_sse_stream(chunks))
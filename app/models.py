@@ -1,10 +1,23 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class QueryRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     airport: str = Field(..., description="IATA код аэропорта (например, DXB)")
     question: str = Field(..., min_length=5, description="Вопрос пользователя")
 
 
-class QueryResponse(BaseModel):
-    answer: str
+class Flight(BaseModel):
+    """Компактная запись о рейсе для промпта LLM; короткие ключи экономят токены."""
+    model_config = ConfigDict(extra='ignore')
+
+    t: str = Field(..., description="Тип рейса: arrival или departure")
+    fn: str | None = Field(None, description="Номер рейса")
+    al: str | None = Field(None, description="Авиакомпания")
+    st: str | None = Field(None, description="Статус")
+    ac: str | None = Field(None, description="Модель самолёта")
+    ap: str | None = Field(None, description="Аэропорт вылета (для arrival) или назначения (для departure)")
+    ci: str | None = Field(None, description="Город аэропорта ap")
+    co: str | None = Field(None, description="Страна аэропорта ap")
+    tm: str | None = Field(None, description="Время по расписанию, UTC")
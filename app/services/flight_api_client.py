@@ -1,141 +1,287 @@
 import asyncio
+import heapq
+import logging
+import time
 import aiohttp
-from typing import Any
+import fastjsonschema
+from typing import Callable, Iterator
 from datetime import datetime, timezone
-from async_lru import alru_cache
+from functools import lru_cache
+from operator import attrgetter
+
+from pydantic import TypeAdapter
 
 from app.config import settings
+from app.models import Flight
+
+log = logging.getLogger(__name__)
 
 FLIGHT_API_BASE_URL = "https://api.flightapi.io/schedule"
+CACHE_TTL = 600  # секунд
+
+# Ограничение размера промпта: не больше MAX_PROMPT_FLIGHTS рейсов; завершённые рейсы
+# (статус начинается с FINISHED_STATUSES) старше FINISHED_MAX_AGE секунд отбрасываются
+MAX_PROMPT_FLIGHTS = 150
+FINISHED_MAX_AGE = 3600
+FINISHED_STATUSES = ('landed', 'departed')
+
+# airport_code -> (время запуска загрузки, задача загрузки).
+# Параллельные запросы к одному аэропорту ждут одну и ту же задачу.
+_CACHE: dict[str, tuple[float, asyncio.Task]] = {}
+
+# Общая сессия, создаётся и закрывается в lifespan приложения (app.main)
+_SESSION: aiohttp.ClientSession | None = None
+
+
+class FlightAPIError(Exception):
+    """Не удалось получить расписание от FlightAPI."""
+
+
+def _obj(**properties: dict) -> dict:
+    """Схема объекта; отсутствующий объект заменяется скелетом из значений по умолчанию."""
+    return {
+        "type": "object",
+        "properties": properties,
+        "default": {name: schema["default"] for name, schema in properties.items()},
+    }
+
+
+def _nullable(schema: dict) -> dict:
+    """Та же схема объекта, но значение null тоже допустимо."""
+    return {**schema, "type": ["object", "null"]}
+
+
+_LEAF = {"type": ["string", "null"], "default": None}
+_TIMESTAMP = {"type": ["integer", "null"], "default": None}
+_AIRPORT = _obj(
+    name=_LEAF,
+    position=_nullable(_obj(region=_nullable(_obj(city=_LEAF)), country=_nullable(_obj(name=_LEAF)))),
+)
 
 
+def _flight_schema(airport_key: str, time_key: str) -> dict:
+    """
+    Схема записи "flight" из расписания FlightAPI для одного направления.
+    Описывает только поля, которые читает соответствующая проекция: после валидации
+    они гарантированно присутствуют (значения null допустимы там, где их допускает API).
+    """
+    return _obj(
+        identification=_obj(number=_obj(default=_LEAF)),
+        airline=_nullable(_obj(name=_LEAF)),
+        status=_obj(text=_LEAF),
+        aircraft=_obj(model=_obj(text=_LEAF)),
+        airport=_obj(**{airport_key: _AIRPORT}),
+        time=_obj(scheduled=_obj(**{time_key: _TIMESTAMP})),
+    )
+
+
+ARRIVAL_SCHEMA = _flight_schema('origin', 'arrival')
+DEPARTURE_SCHEMA = _flight_schema('destination', 'departure')
+
+validate_arrival = fastjsonschema.compile(ARRIVAL_SCHEMA)
+validate_departure = fastjsonschema.compile(DEPARTURE_SCHEMA)
+
+# Сериализатор pydantic-core, собирается один раз
+_FLIGHTS_ADAPTER = TypeAdapter(list[Flight])
+
+
+@lru_cache(maxsize=4096)
 def convert_timestamp(ts: int | None) -> str | None:
     """Конвертирует UNIX timestamp в читаемую строку времени ISO 8601."""
-    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z') if ts else None
+    return _format_timestamp(ts) if ts else None
+
 
+def _format_timestamp(ts: float) -> str:
+    """Форматирует UNIX timestamp без кэша (для разовых значений вроде текущего времени)."""
+    # isoformat быстрее strftime; tzinfo убирается, чтобы не получить суффикс "+00:00"
+    return datetime.fromtimestamp(ts, tz=timezone.utc).replace(tzinfo=None).isoformat(sep=' ', timespec='seconds') + ' UTC'
 
-@alru_cache(maxsize=12, ttl=600)
-async def get_flight_data(airport_code: str) -> list[dict[str, Any]]:
+
+async def get_flight_data(airport_code: str) -> tuple[list[Flight], str]:
     """
     Асинхронно получает данные о прибывающих и убывающих рейсах для аэропорта.
-    Результаты кэшируются на 10 минут.
+    Возвращает список рейсов и его JSON-представление для промпта.
+    Результаты кэшируются на 10 минут, одновременные промахи кэша
+    объединяются в один запрос к API. Ошибки не кэшируются.
+    """
+    now = time.monotonic()
+    entry = _CACHE.get(airport_code)
+    if entry is None or now - entry[0] >= CACHE_TTL:
+        task = asyncio.create_task(_fetch_flight_data(airport_code))
+        task.add_done_callback(lambda t: _evict_failed(airport_code, t))
+        entry = (now, task)
+        _CACHE[airport_code] = entry
+
+    # shield: отмена одного клиента не должна отменять общую загрузку
+    return await asyncio.shield(entry[1])
+
+
+def _evict_failed(airport_code: str, task: asyncio.Task) -> None:
+    """Удаляет из кэша завершившуюся с ошибкой загрузку."""
+    if task.cancelled() or task.exception() is not None:
+        entry = _CACHE.get(airport_code)
+        if entry is not None and entry[1] is task:
+            del _CACHE[airport_code]
+
+
+async def _fetch_flight_data(airport_code: str) -> tuple[list[Flight], str]:
     """
-    print(f"🚀 Fetching new data from API for {airport_code}")
+    Загружает прибывающие и убывающие рейсы без кэша.
+    Если хотя бы один из запросов не удался, выбрасывается FlightAPIError.
+    """
+    log.info("Fetching new data from API for %s", airport_code)
 
-    tasks = [
-        fetch_schedule(airport_code, 'arrival'),
-        fetch_schedule(airport_code, 'departure')
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Оба запроса идут через одну сессию и делят пул соединений
+    results = await asyncio.gather(
+        fetch_schedule(_SESSION, airport_code, 'arrival'),
+        fetch_schedule(_SESSION, airport_code, 'departure'),
+        return_exceptions=True,
+    )
 
     all_flights = []
     for result in results:
         if isinstance(result, Exception):
-            print(f"An error occurred during API fetch: {result}")
-        else:
-            all_flights.extend(result)
+            log.warning("An error occurred during API fetch: %s", result)
+            raise FlightAPIError(f"Failed to fetch flight data for {airport_code}") from result
+        all_flights.extend(result)
+
+    all_flights = select_prompt_flights(all_flights)
+    flight_data_str = _FLIGHTS_ADAPTER.dump_json(all_flights, exclude_none=True).decode()
+    return all_flights, flight_data_str
+
+
+def select_prompt_flights(flights: list[Flight]) -> list[Flight]:
+    """
+    Оставляет не больше MAX_PROMPT_FLIGHTS рейсов, ближайших к текущему моменту,
+    чтобы промпт гарантированно помещался в контекст модели. Сначала идут
+    предстоящие рейсы (ближайшие первыми), затем прошедшие по расписанию (самые свежие
+    первыми), рейсы без времени идут в конец. Завершённые рейсы старше FINISHED_MAX_AGE
+    отбрасываются; задержанные и прочие незавершённые рейсы остаются независимо от времени.
+    """
+    # Строки времени в формате convert_timestamp сравниваются лексикографически
+    now = time.time()
+    now_str = _format_timestamp(now)
+    cutoff = _format_timestamp(now - FINISHED_MAX_AGE)
+
+    upcoming, past, untimed = [], [], []
+    for flight in flights:
+        if flight.tm is None:
+            untimed.append(flight)
+        elif flight.tm >= now_str:
+            upcoming.append(flight)
+        elif flight.tm >= cutoff or not _is_finished(flight):
+            past.append(flight)
+
+    # nsmallest/nlargest не сортируют весь список
+    selected = heapq.nsmallest(MAX_PROMPT_FLIGHTS, upcoming, key=_scheduled_time)
+    selected += heapq.nlargest(MAX_PROMPT_FLIGHTS - len(selected), past, key=_scheduled_time)
+    selected += untimed[:MAX_PROMPT_FLIGHTS - len(selected)]
+    return selected
 
-    return all_flights
 
+_scheduled_time = attrgetter('tm')
 
-async def fetch_schedule(airport_code: str, flight_type: str) -> list[dict[str, Any]]:
+
+def _is_finished(flight: Flight) -> bool:
+    """Рейс уже приземлился или вылетел (статус вида "Landed 10:32" / "Departed 09:15")."""
+    return flight.st is not None and flight.st.lower().startswith(FINISHED_STATUSES)
+
+
+async def fetch_schedule(
+        session: aiohttp.ClientSession, airport_code: str, flight_type: str
+) -> list[Flight]:
     """Вспомогательная функция для выполнения одного запроса к API"""
 
     url = f"{FLIGHT_API_BASE_URL}/{settings.FLIGHT_API_KEY}"
     api_mode = "arrivals" if flight_type == "arrival" else "departures"
-    res = []
 
     params = {"mode": api_mode, "iata": airport_code, "day": "1"}
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-
-                print(f"Raw API response for {airport_code} {flight_type}: {data.keys() if isinstance(data, dict) else "not a dict"}")
+    async with session.get(url, params=params) as response:
+        response.raise_for_status()
+        data = await response.json()
 
-                if "error" in data:
-                    print(f"API returned an error for {airport_code} ({flight_type}): {data["error"]}")
-                    return []
+        log.debug("Raw API response for %s %s: %s",
+                  airport_code, flight_type, data.keys() if isinstance(data, dict) else "not a dict")
 
-                plugin_data = data.get("airport", {}).get("pluginData", {})
-                schedule_data = plugin_data.get('schedule', {}).get(api_mode, {}).get("data", [])
+        if "error" in data:
+            raise FlightAPIError(f"API returned an error for {airport_code} ({flight_type}): {data['error']}")
 
-                print(f"Found {len(schedule_data)} schedule items")
+        plugin_data = data.get("airport", {}).get("pluginData", {})
+        schedule_data = plugin_data.get('schedule', {}).get(api_mode, {}).get("data", [])
 
-                flights_list = []
-                for item in schedule_data:
-                    if flight := item.get("flight"):
-                        flights_list.append(flight)
-                    else:
-                        print(f"Warning: No flight data in item: {item.keys()}")
+        log.debug("Found %d schedule items", len(schedule_data))
 
-                print(f"Extracted {len(flights_list)} flights")
-                res = simplify_flight_data(flights_list, flight_type)
+        flights_list = []
+        for item in schedule_data:
+            if flight := item.get("flight"):
+                flights_list.append(flight)
+            else:
+                log.warning("No flight data in item: %s", item.keys())
 
-        except aiohttp.ClientError as e:
-            print(f"Error fetching {flight_type} data for {airport_code}: {e}")
-        except Exception as e:
-            print(f"Unexpected error processing {flight_type} data for {airport_code}: {e}")
-        finally:
-            return res
+        log.debug("Extracted %d flights", len(flights_list))
+        return simplify_flight_data(flights_list, flight_type)
 
 
-def simplify_flight_data(flights: list[dict], flight_type: str) -> list[dict]:
+def simplify_flight_data(flights: list[dict], flight_type: str) -> list[Flight]:
     """
-    Упрощает структуру данных о рейсах с обработкой отсутствующих данных.
+    Упрощает структуру данных о рейсах до компактных записей Flight с короткими ключами
+    (расшифровка ключей — в промпте llm_service). Записи, не прошедшие валидацию
+    по ARRIVAL_SCHEMA / DEPARTURE_SCHEMA, пропускаются.
     """
-    simplified_flights = []
+    if flight_type == 'arrival':
+        simplify, validate = _simplify_arrival, validate_arrival
+    else:
+        simplify, validate = _simplify_departure, validate_departure
+    return [simplify(flight) for flight in _valid_flights(flights, validate)]
+
 
+def _valid_flights(flights: list[dict], validate: Callable[[dict], dict]) -> Iterator[dict]:
+    """Валидирует записи и дополняет их значениями по умолчанию; некорректные пропускает."""
     for flight in flights:
         try:
-            # Базовая информация о рейсе
-            identification = flight.get('identification', {})
-            airline_info = flight.get('airline', {})
-            status_info = flight.get('status', {})
-            aircraft_info = flight.get('aircraft', {})
-            airport_info = flight.get('airport', {})
-            time_info = flight.get('time', {})
-
-            record = {
-                "type": flight_type,
-                "flightNumber": identification.get('number', {}).get('default'),
-                "airline": airline_info.get('name') if airline_info else None,  # Безопасная проверка
-                "status": status_info.get('text'),
-                "aircraftModel": aircraft_info.get('model', {}).get('text'),
-            }
-
-            if flight_type == 'arrival':
-                origin = airport_info.get('origin', {})
-                origin_position = origin.get('position', {})
-                origin_region = origin_position.get('region', {}) if origin_position else {}
-                origin_country = origin_position.get('country', {}) if origin_position else {}
-
-                record.update({
-                    "originAirport": origin.get('name'),
-                    "originCity": origin_region.get('city') if origin_region else None,
-                    "originCountry": origin_country.get('name') if origin_country else None,
-                    "scheduledTime": convert_timestamp(time_info.get('scheduled', {}).get('arrival'))
-                })
-            else:  # departure
-                destination = airport_info.get('destination', {})
-                destination_position = destination.get('position', {})
-                destination_region = destination_position.get('region', {}) if destination_position else {}
-                destination_country = destination_position.get('country', {}) if destination_position else {}
-
-                record.update({
-                    "destinationAirport": destination.get('name'),
-                    "destinationCity": destination_region.get('city') if destination_region else None,
-                    "destinationCountry": destination_country.get('name') if destination_country else None,
-                    "scheduledTime": convert_timestamp(time_info.get('scheduled', {}).get('departure'))
-                })
-
-            simplified_flights.append(record)
-
-        except Exception as e:
-            print(f"Error processing flight record: {e}")
-            print(f"Problematic flight data keys: {list(flight.keys()) if isinstance(flight, dict) else 'not a dict'}")
-            continue
-
-    return simplified_flights
\ No newline at end of file
+            yield validate(flight)
+        except fastjsonschema.JsonSchemaException as e:
+            log.warning("Error processing flight record: %s", e)
+            log.debug("Problematic flight data keys: %s", flight.keys() if isinstance(flight, dict) else "not a dict")
+
+
+def _simplify_arrival(flight: dict) -> Flight:
+    airline = flight['airline']
+    airport, city, country = _airport_fields(flight['airport']['origin'])
+    # Данные уже проверены validate_arrival, повторная валидация pydantic не нужна
+    return Flight.model_construct(
+        t="arrival",
+        fn=flight['identification']['number']['default'],
+        al=airline['name'] if airline else None,
+        st=flight['status']['text'],
+        ac=flight['aircraft']['model']['text'],
+        ap=airport,
+        ci=city,
+        co=country,
+        tm=convert_timestamp(flight['time']['scheduled']['arrival']),
+    )
+
+
+def _simplify_departure(flight: dict) -> Flight:
+    airline = flight['airline']
+    airport, city, country = _airport_fields(flight['airport']['destination'])
+    return Flight.model_construct(
+        t="departure",
+        fn=flight['identification']['number']['default'],
+        al=airline['name'] if airline else None,
+        st=flight['status']['text'],
+        ac=flight['aircraft']['model']['text'],
+        ap=airport,
+        ci=city,
+        co=country,
+        tm=convert_timestamp(flight['time']['scheduled']['departure']),
+    )
+
+
+def _airport_fields(airport: dict) -> tuple[str | None, str | None, str | None]:
+    """Название, город и страна аэропорта; position, region и country могут быть null."""
+    position = airport['position']
+    region = position['region'] if position else None
+    country = position['country'] if position else None
+    return airport['name'], region['city'] if region else None, country['name'] if country else None
@@ -1,29 +1,24 @@
-import json
-from typing import Any
-from openai import AsyncOpenAI
-
-from app.config import settings
+import logging
+from typing import AsyncIterator
 
-# Настраиваем асинхронный клиент
-client = AsyncOpenAI(
-    api_key=settings.OPENROUTER_API_KEY,
-    base_url="https://openrouter.ai/api/v1",
-)
+from openai import AsyncOpenAI
 
+log = logging.getLogger(__name__)
 
-async def get_answer_from_llm(question: str, flight_data: list[dict[str, Any]], airport_code: str) -> str:
-    """
-    Асинхронно отправляет вопрос и данные в LLM для получения ответа.
-    """
-    if not flight_data:
-        return "К сожалению, не удалось получить данные о рейсах. Попробуйте позже."
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
-    flight_data_str = json.dumps(flight_data, indent=2, ensure_ascii=False)
+# Асинхронный клиент LLM поверх общего httpx-клиента с HTTP/2;
+# создаётся и закрывается в lifespan приложения (app.main)
+_CLIENT: AsyncOpenAI | None = None
 
-    prompt = f"""
+# Шаблон промпта; подставляется через str.format
+_PROMPT_TMPL = """
     You are an expert flight data analyst. Your task is to answer user questions based *only* on the provided JSON data for the airport {airport_code}.
     Do not use any external knowledge or make assumptions. If the data does not contain the answer, state that clearly.
-    The data contains both 'arrival' and 'departure' flights. Pay close attention to the 'type' field.
+    The data contains both 'arrival' and 'departure' flights. Pay close attention to the 't' field.
+    Keys: t - type (arrival/departure), fn - flight number, al - airline, st - status, ac - aircraft model,
+    ap/ci/co - airport/city/country of origin for arrivals and of destination for departures,
+    tm - scheduled time (UTC). A missing key means the value is unknown.
 
     Here is the flight data:
     {flight_data_str}
@@ -31,16 +26,30 @@ async def get_answer_from_llm(question: str, flight_data: list[dict[str, Any]],
     User's question: "{question}"
     """
 
+
+async def get_answer_from_llm(question: str, flight_data_str: str, airport_code: str) -> AsyncIterator[str]:
+    """
+    Асинхронно отправляет вопрос и данные в LLM и отдаёт ответ по частям по мере генерации.
+    flight_data_str — уже сериализованные в JSON данные о рейсах (см. get_flight_data).
+    """
+    prompt = _PROMPT_TMPL.format(airport_code=airport_code, flight_data_str=flight_data_str, question=question)
+
     try:
-        response = await client.chat.completions.create(
+        stream = await _CLIENT.chat.completions.create(
             model="mistralai/mistral-7b-instruct:free",
             messages=[
                 {"role": "system", "content": "You are a helpful flight data analyst."},
                 {"role": "user", "content": prompt},
             ],
             temperature=0.1,
+            stream=True,
         )
-        return response.choices[0].message.content
+        # async with закрывает ответ OpenRouter и при отключении клиента (отмене генератора),
+        # освобождая поток в общем HTTP/2-соединении
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and (delta := chunk.choices[0].delta.content):
+                    yield delta
     except Exception as e:
-        print(f"Error querying LLM: {e}")
-        return "Произошла ошибка при обработке вашего вопроса. Пожалуйста, попробуйте снова."
+        log.error("Error querying LLM: %s", e)
+        yield "Произошла ошибка при обработке вашего вопроса. Пожалуйста, попробуйте снова."